@@ -1,7 +1,9 @@
 from datetime import datetime
+import asyncio
 import os
 import sys
 import time
+from dataclasses import dataclass
 from enum import Enum
 import argparse
 import logging
@@ -24,164 +26,295 @@ class SessionType(Enum):
     CORRUPTED = 'corrupted'
 
 
+# Hot-path string constants so per-event logging skips the Enum descriptor lookup
+_JOIN_EVENT: str = EventType.JOIN.value
+_LEAVE_EVENT: str = EventType.LEAVE.value
+_SESSION_COMPLETE: str = SessionType.COMPLETE.value
+_SESSION_CORRUPTED: str = SessionType.CORRUPTED.value
+
+
+@dataclass(slots=True)
+class TrackedConnection:
+    """One active voice session, kept in memory between the join and leave events."""
+    member_name: str
+    timestamp: int
+    guild_name: str
+    channel_name: str
+    channel_id: int
+
+
 class RecapBot(discord.Client):
 
+    # Tracked connections whose join event is older than this are considered
+    # lost (gateway reconnect, missed leave event) and evicted as corrupted
+    CONNECTION_TTL_NS: int = 24 * 3600 * 1_000_000_000
+    TTL_SWEEP_INTERVAL_NS: int = 3600 * 1_000_000_000
+    # Voice updates are sharded by member id across this many worker tasks;
+    # one member always lands on the same worker, keeping their events ordered
+    VOICE_WORKER_COUNT: int = 4
+    # Upper bound on pooled TrackedConnection instances kept for reuse
+    CONNECTION_POOL_SIZE: int = 512
+
     def __init__(self, mode: str, data_path: str, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.mode: str = mode
-        self.currently_tracked_connections: dict = {}
+        # Sharded per guild: the inner dict hashes a single member-id int
+        # instead of a packed composite key
+        self.currently_tracked_connections: dict[int, dict[int, TrackedConnection]] = {}
         self.data_handler = DataHandler(data_path)
+        self._flush_task: asyncio.Task | None = None
+        self._last_ttl_sweep: int = time.time_ns()
+        self._voice_queues: list[asyncio.Queue] = [asyncio.Queue() for _ in range(self.VOICE_WORKER_COUNT)]
+        self._voice_workers: list[asyncio.Task] = []
+        self._connection_pool: list[TrackedConnection] = []
+        # Canonical str per guild/channel name so concurrent sessions in the
+        # same channel share one backing string instead of holding copies
+        self._name_cache: dict[str, str] = {}
 
 
     async def on_ready(self) -> None:
         logger.info(f'Logged in as {self.user.name}')
         logger.info('Checking file structure for all guilds the bot is in, creating missing directories')
-        for guild in self.guilds:
-            self.data_handler.ensure_guild_files_exist(guild.id)
-
-    async def on_message(self, message) -> None:
-        logger.debug(f'Message received from {message.author}: {message.content}')
-        # TODO: Build message logging
-        # TODO: {timestamp; author; guild; channel_id}
+        # Known guilds were already warmed from disk; only genuinely new ones do
+        # file work, concurrently and off the event loop
+        missing_guilds = [guild for guild in self.guilds
+                          if guild.id not in self.data_handler.initialized_guilds_ids]
+        if missing_guilds:
+            await asyncio.gather(*[asyncio.to_thread(self.data_handler.ensure_guild_files_exist, guild.id)
+                                   for guild in missing_guilds])
+        # Stat every guild directory off the event loop so dentries and inodes
+        # are cached before the first voice event instead of on its hot path
+        await asyncio.gather(*[asyncio.to_thread(os.stat,
+                                                 os.path.join(self.data_handler.DATA_PATH, str(guild.id)))
+                               for guild in self.guilds],
+                             return_exceptions=True)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if not self._voice_workers:
+            self._voice_workers = [asyncio.create_task(self._voice_worker(voice_queue))
+                                   for voice_queue in self._voice_queues]
+
+    async def _voice_worker(self, voice_queue: asyncio.Queue) -> None:
+        while True:
+            member, channel_before, channel_after, timestamp = await voice_queue.get()
+            try:
+                self._process_voice_update(member, channel_before, channel_after, timestamp)
+            except Exception:
+                logger.exception(f'Failed to process voice update of member {member.id}')
+            voice_queue.task_done()
+
+    async def _flush_loop(self) -> None:
+        """Periodically flushes buffered log lines so the data-loss window stays bounded."""
+        interval: float = self.data_handler.batch_interval_ms / 1000
+        while True:
+            await asyncio.sleep(interval)
+            self.data_handler.flush_all()
+
+    async def on_disconnect(self) -> None:
+        logger.debug('Disconnected from gateway, flushing buffered log lines')
+        self.data_handler.flush_all()
+
+    # TODO: Build message logging ({timestamp; author; guild; channel_id}); when it
+    # lands, re-enable the messages intent in get_bot_intents and add on_message
 
     async def on_guild_join(self, guild: discord.Guild) -> None:
         logger.info(f'Bot has joined guild {guild.name} with id {guild.id}')
         self.data_handler.ensure_guild_files_exist(guild.id)
-        self.data_handler.log_guild_bot_join(time.time(), guild.id, guild.name)
+        self.data_handler.log_guild_bot_join(time.time_ns(), guild.id, guild.name)
 
     async def on_guild_update(self, before: discord.Guild, after: discord.Guild) -> None:
         logger.debug('A guild has been updated')
-        timestamp: float = time.time()
+        timestamp: int = time.time_ns()
         if before.name != after.name:
-            logger.debug(f'Name changed from {before.name} to {after.name}')
+            logger.debug('Name changed from %s to %s', before.name, after.name)
             self.data_handler.log_guild_rename(timestamp, before.id, before.name, after.name)
 
 
     async def on_guild_channel_create(self, channel) -> None:
-        timestamp: float = time.time()
+        timestamp: int = time.time_ns()
         category_id = channel.category.id if channel.category is not None else None
-        logger.debug(f'A channel has been created in guild {channel.guild} with name {channel.name}')
+        logger.debug('A channel has been created in guild %s with name %s', channel.guild, channel.name)
         self.data_handler.log_guild_channel_add(timestamp, channel.guild.id, channel.id, channel.name,
                                                     category_id, channel.type.name)
 
     async def on_guild_channel_delete(self, channel) -> None:
-        timestamp: float = time.time()
+        timestamp: int = time.time_ns()
         category_id = channel.category.id if channel.category is not None else None
-        logger.debug(f'A channel has been deleted in guild {channel.guild} with name {channel.name}')
+        logger.debug('A channel has been deleted in guild %s with name %s', channel.guild, channel.name)
         self.data_handler.log_guild_channel_remove(timestamp, channel.guild.id, channel.id, channel.name,
                                                 category_id, channel.type.name)
 
     async def on_guild_channel_update(self, before, after) -> None:
-        timestamp: float = time.time()
+        timestamp: int = time.time_ns()
         category_before_id = before.category.id if before.category is not None else None
         category_after_id = after.category.id if after.category is not None else None
         if before.name != after.name:
-            logger.debug(f'A channel has changed name in guild {before.guild} from {before.name} to {after.name}')
+            logger.debug('A channel has changed name in guild %s from %s to %s', before.guild, before.name, after.name)
             self.data_handler.log_guild_channel_rename(timestamp, before.guild.id, before.id, before.name,
                                                     after.name, category_before_id, before.type.name)
 
         if category_before_id != category_after_id:
-            logger.debug(f'Category of {after.name} changed from {category_before_id} to {category_after_id}')
+            logger.debug('Category of %s changed from %s to %s', after.name, category_before_id, category_after_id)
             self.data_handler.log_guild_channel_category_change(timestamp, before.guild.id, before.id, before.name,
                                                                 category_before_id, category_after_id, before.type.name)
 
     async def on_member_join(self, member: discord.Member) -> None:
         logger.info(f'Member {member.name} with id {member.id} joined guild {member.guild.name}')
-        timestamp: float = time.time()
+        timestamp: int = time.time_ns()
         self.data_handler.log_guild_member_join(timestamp, member.guild.id, member.id, member.name)
 
     async def on_member_remove(self, member: discord.Member) -> None:
-        logger.debug(f'Member {member.name} ({member.id}) has been removed from guild {member.guild.name}')
-        timestamp: float = time.time()
+        logger.debug('Member %s (%s) has been removed from guild %s', member.name, member.id, member.guild.name)
+        timestamp: int = time.time_ns()
         self.data_handler.log_guild_member_remove(timestamp, member.guild.id, member.id, member.name)
 
 
     async def on_voice_state_update(self, member, before, after) -> None:
 
-        logger.debug('Received a voice state update')
-        logger.debug(f'Voice state update by Member {str(member.name)}({str(member.id)}) '
-                     f'in guild {member.guild.name}({str(member.guild.id)})')
-        logger.debug(f'Old state: {before}')
-        logger.debug(f'New state: {after}')
-
-        timestamp: float = time.time()
-
-        # If channel stays the same it means user has not switched channel obviously
-        if before.channel == after.channel:
+        # Mute/deafen/stream toggles are the most frequent voice updates; bail
+        # out before reading the clock or logging anything for them.
+        # Identity check suffices: discord.py hands out the cached channel object
+        # per guild, and the both-None case is identity too
+        if before.channel is after.channel:
             return
 
+        # %-style lazy formatting: no strings (or VoiceState reprs) are built
+        # unless a handler actually accepts DEBUG
+        logger.debug('Voice state update by Member %s(%s) in guild %s(%s)',
+                     member.name, member.id, member.guild.name, member.guild.id)
+        logger.debug('Old state: %s', before)
+        logger.debug('New state: %s', after)
 
-        guild = member.guild
+        timestamp: int = time.time_ns()
+        self._evict_stale_connections(timestamp)
 
-        channel_after: VoiceChannel = after.channel
-        channel_before: VoiceChannel = before.channel
+        # Hand the actual processing to the worker shard for this member so the
+        # gateway dispatch only pays for an enqueue
+        self._voice_queues[member.id % self.VOICE_WORKER_COUNT].put_nowait(
+            (member, before.channel, after.channel, timestamp))
 
+    def _process_voice_update(self, member: discord.Member, channel_before: VoiceChannel | None,
+                              channel_after: VoiceChannel | None, timestamp: int) -> None:
+        guild = member.guild
 
         # If before is None, user has joined a channel
         # --> handle join with member, channel and time
-        if before.channel is None:
+        if channel_before is None:
             self.data_handler.log_event(member.id, member.name, timestamp, guild.id, guild.name,
-                           channel_after.id, channel_after.name, EventType.JOIN.value)
+                           channel_after.id, channel_after.name, _JOIN_EVENT)
             self.handle_voice_join(member, timestamp, channel_after)
             return
 
         # If after is None, user has left the VC completely
         # --> handle leave with member and time
-        if after.channel is None:
+        if channel_after is None:
             self.data_handler.log_event(member.id, member.name, timestamp, guild.id, guild.name,
-                           channel_before.id, channel_before.name, EventType.LEAVE.value)
+                           channel_before.id, channel_before.name, _LEAVE_EVENT)
             self.handle_voice_leave(member, timestamp, channel_before)
             return
 
         # If after and before both are not None
         # --> handle leaving the old channel
         # --> handle joining the new channel
-        self.data_handler.log_event(member.id, member.name, timestamp, guild.id, guild.name,
-                       channel_before.id, channel_before.name, EventType.LEAVE.value)
-        self.data_handler.log_event(member.id, member.name, timestamp, guild.id, guild.name,
-                       channel_after.id, channel_after.name, EventType.JOIN.value)
+        # Both rows go out as one batched append
+        self.data_handler.log_events(member.id, member.name, timestamp, guild.id, guild.name,
+                                     [(channel_before.id, channel_before.name, _LEAVE_EVENT),
+                                      (channel_after.id, channel_after.name, _JOIN_EVENT)])
 
         self.handle_voice_leave(member, timestamp, channel_before)
         self.handle_voice_join(member, timestamp, channel_after)
 
 
 
-    def handle_voice_join(self, member: discord.Member, timestamp: float, voice_channel: discord.VoiceChannel) -> None:
+    def _evict_stale_connections(self, timestamp: int) -> None:
+        """
+        Drops tracked connections older than the TTL so lost leave events cannot
+        grow the dict unboundedly. Runs at most once per sweep interval.
+        """
+        if timestamp - self._last_ttl_sweep < self.TTL_SWEEP_INTERVAL_NS:
+            return
+        self._last_ttl_sweep = timestamp
+        stale_keys = [(guild_id, member_id)
+                      for guild_id, guild_connections in self.currently_tracked_connections.items()
+                      for member_id, connection in guild_connections.items()
+                      if timestamp - connection.timestamp > self.CONNECTION_TTL_NS]
+        for guild_id, member_id in stale_keys:
+            connection = self.currently_tracked_connections[guild_id].pop(member_id)
+            logger.warning(f'Evicting stale voice connection of member {connection.member_name} ({member_id}) '
+                           f'in guild {guild_id}, logging session as corrupted')
+            self.data_handler.log_session(member_id, connection.member_name, connection.timestamp, 0,
+                                          guild_id, connection.guild_name, connection.channel_id,
+                                          connection.channel_name, _SESSION_CORRUPTED)
+            self._release_connection(connection)
+
+    def handle_voice_join(self, member: discord.Member, timestamp: int, voice_channel: discord.VoiceChannel) -> None:
         """
         Stores the connection of the member in a dictionary. Will write to file when user leaves
         :return:
         """
         guild = member.guild
-        connection: dict = {'member_name': member.name, 'timestamp': timestamp, 'guild_name': guild.name,
-                            'channel_name': voice_channel.name, 'channel_id': voice_channel.id}
-        self.currently_tracked_connections[(member.id, guild.id)] = connection
+        connection = self._acquire_connection(member.name, timestamp, self._intern_name(guild.name),
+                                              self._intern_name(voice_channel.name), voice_channel.id)
+        self.currently_tracked_connections.setdefault(guild.id, {})[member.id] = connection
+
+    def _intern_name(self, name: str) -> str:
+        if len(self._name_cache) > 4096:
+            # Bound the cache; renames and guild churn would otherwise grow it forever
+            self._name_cache.clear()
+        return self._name_cache.setdefault(name, name)
+
+    def _acquire_connection(self, member_name: str, timestamp: int, guild_name: str,
+                            channel_name: str, channel_id: int) -> TrackedConnection:
+        if self._connection_pool:
+            connection = self._connection_pool.pop()
+            connection.member_name = member_name
+            connection.timestamp = timestamp
+            connection.guild_name = guild_name
+            connection.channel_name = channel_name
+            connection.channel_id = channel_id
+            return connection
+        return TrackedConnection(member_name, timestamp, guild_name, channel_name, channel_id)
+
+    def _release_connection(self, connection: TrackedConnection) -> None:
+        """Returns a finished connection to the pool, dropping its string references."""
+        if len(self._connection_pool) >= self.CONNECTION_POOL_SIZE:
+            return
+        connection.member_name = ''
+        connection.guild_name = ''
+        connection.channel_name = ''
+        self._connection_pool.append(connection)
 
-    def handle_voice_leave(self, member: discord.Member, timestamp: float, voice_channel: discord.VoiceChannel) -> None:
+    def handle_voice_leave(self, member: discord.Member, timestamp: int, voice_channel: discord.VoiceChannel) -> None:
         member_id: int = member.id
         guild = member.guild
         guild_id: int = guild.id
-        if (member_id, guild_id) in self.currently_tracked_connections:
+        # pop with a default instead of `in` + pop: one hash lookup on the
+        # most frequent path instead of two
+        guild_connections: dict[int, TrackedConnection] | None = self.currently_tracked_connections.get(guild_id)
+        tracked_connection: TrackedConnection | None = \
+            guild_connections.pop(member_id, None) if guild_connections is not None else None
+        if tracked_connection is not None:
             # Session complete
-            tracked_connection: dict = self.currently_tracked_connections.pop((member_id, guild_id))
-            member_name: str = tracked_connection['member_name']
-            start_time: float = tracked_connection['timestamp']
-            duration: float = timestamp - start_time
-            guild_name: str = tracked_connection['guild_name']
-            channel_id: int = tracked_connection['channel_id']
-            channel_name: str = tracked_connection['channel_name']
-            session_type: SessionType = SessionType.COMPLETE
+            member_name: str = tracked_connection.member_name
+            start_time: int = tracked_connection.timestamp
+            duration: int = timestamp - start_time
+            guild_name: str = tracked_connection.guild_name
+            channel_id: int = tracked_connection.channel_id
+            channel_name: str = tracked_connection.channel_name
+            session_type: str = _SESSION_COMPLETE
+            self._release_connection(tracked_connection)
         else:
             # Session corrupted, leave event without join
             member_name: str = member.name
-            start_time: float = -1
-            duration: float = 0
+            start_time: int = -1
+            duration: int = 0
             guild_name: str = guild.name
             channel_id: int = voice_channel.id
             channel_name: str = voice_channel.name
-            session_type: SessionType = SessionType.CORRUPTED
+            session_type: str = _SESSION_CORRUPTED
 
         self.data_handler.log_session(member_id, member_name, start_time, duration, guild_id, guild_name,
-                                    channel_id, channel_name, session_type.value)
+                                    channel_id, channel_name, session_type)
 
         #logger.debug(f'A session has been ended, logging: {session_csv_string}')
 
@@ -227,7 +360,7 @@ def init_logs(mode: str) -> None:
     if not os.path.exists('logs'):
         os.mkdir('logs')
 
-    timestamp_str: str = datetime.fromtimestamp(time.time()).strftime("%Y-%m-%d_%H-%M-%S")
+    timestamp_str: str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     logfile_name: str = f'logs-dev-{timestamp_str}.log' if mode == 'dev' else f'logs-prod-{timestamp_str}.log'
     level = logging.DEBUG if mode == 'dev' else logging.INFO
 
@@ -246,11 +379,12 @@ def init_logs(mode: str) -> None:
     logger.addHandler(stdout_handler)
 
 def get_bot_intents() -> Intents:
-    intents = discord.Intents.default()
+    # Start from none() and opt in, so Discord does not stream events (most
+    # notably every message) that no handler consumes
+    intents = discord.Intents.none()
     intents.voice_states = True
     intents.guilds = True
     intents.members = True
-    intents.messages = True
     return intents
 
 if __name__ == '__main__':
@@ -1,11 +1,41 @@
+import atexit
 import enum
 import json
 import os
 import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from recap_database import RecapDatabase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 logger = logging.getLogger('ServerRecapBot.data')
 
+def _json_line(json_object: dict) -> bytes:
+    """Serializes one guild event to a JSONL line, preferring orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(json_object) + b'\n'
+    return (json.dumps(json_object) + '\n').encode('utf-8')
+
+# Substitutions for characters that would break a CSV row; built once so
+# sanitizing a field is a single C-level translate scan
+_CSV_SANITIZE_TABLE = str.maketrans({',': '‚', '"': "'", '\n': ' ', '\r': ' '})
+# Any other control character is stripped outright
+for _control_char in (*range(0x20), 0x7f):
+    _CSV_SANITIZE_TABLE.setdefault(_control_char, None)
+del _control_char
+
+def _csv_field(value: str) -> str:
+    """Sanitizes a free-form field (member/guild/channel names) so it cannot break the CSV."""
+    return value.translate(_CSV_SANITIZE_TABLE)
+
 class GuildEvent(enum.Enum):
     CHANNEL_ADD = 'channel_add'
     CHANNEL_REMOVE = 'channel_remove'
@@ -18,75 +48,283 @@ class GuildEvent(enum.Enum):
 
 class DataHandler:
 
+    # Class-level constants: they never change per instance, and class-dict
+    # attribute reads sit better with CPython's inline caches than instance ones
+    EVENT_LOG_HEADER: str = ('member_id,member_name,timestamp_ns,guild_id,guild_name,'
+                             'channel_id,channel_name,event_type\n')
+    SESSION_LOG_HEADER: str = ('member_id,member_name,start_time_ns,duration_ns,guild_id,guild_name,'
+                               'channel_id,channel_name,session_type\n')
+    SESSION_LOG_FILENAME: str = 'session_log.csv'
+    EVENT_LOG_FILENAME: str = 'event_log.csv'
+    GUILD_EVENTS_FILENAME: str = 'guild_events.jsonl'
+    GUILD_METADATA_SNAPSHOT_FILENAME: str = 'guild_snapshot.json'
+    JSON_SCHEMA_VERSION: int = 1
+    # Upper bound on cached log file descriptors; beyond it the least recently
+    # written file is closed so a bot in thousands of guilds cannot exhaust FDs
+    MAX_OPEN_FILES: int = 256
+
     def __init__(self, data_path: str):
         self.initialized_guilds_ids = set()
         self.DATA_PATH: str = data_path
-        if not os.path.exists(self.DATA_PATH):
-            os.mkdir(self.DATA_PATH)
-        self.EVENT_LOG_HEADER: str = ('member_id,member_name,timestamp,guild_id,guild_name,'
-                                      'channel_id,channel_name,event_type\n')
-        self.SESSION_LOG_HEADER: str = ('member_id,member_name,start_time,duration,guild_id,guild_name,'
-                                        'channel_id,channel_name,session_type\n')
-        self.SESSION_LOG_FILENAME: str = 'session_log.csv'
-        self.EVENT_LOG_FILENAME: str = 'event_log.csv'
-        self.GUILD_EVENTS_FILENAME: str = 'guild_events.jsonl'
-        self.GUILD_METADATA_SNAPSHOT_FILENAME: str = 'guild_snapshot.json'
-        self.json_schema_version: int = 1
+        os.makedirs(self.DATA_PATH, exist_ok=True)
+        # Log lines are buffered per file and flushed in one write once a buffer
+        # reaches batch_size rows or the bot's flush loop fires (batch_interval_ms)
+        self.batch_size: int = int(os.getenv('RECAP_BATCH_SIZE', '64'))
+        self.batch_interval_ms: int = int(os.getenv('RECAP_BATCH_MS', '50'))
+        # Group commit: data reaches the page cache on every flush but is only
+        # fsync'd every durability_interval_s seconds or durability_batch
+        # written batches, whichever comes first — that window is the most that
+        # can be lost to a power failure (not to a mere process crash)
+        self.durability_interval_s: float = float(os.getenv('RECAP_DURABILITY_INTERVAL_S', '1.0'))
+        self.durability_batch: int = int(os.getenv('RECAP_DURABILITY_BATCH', '256'))
+        self._buffers: dict[str, list[bytes]] = {}
+        # Joined (event_log, session_log, guild_events) paths per guild so the
+        # hot path never rebuilds them with str(guild_id) + os.path.join
+        self._guild_paths: dict[int, tuple[str, str, str]] = {}
+        # Disk writes happen on a dedicated thread so flushing never blocks the
+        # event loop; the queue is bounded and overflow is dropped with a warning
+        self._write_queue: queue.Queue = queue.Queue(maxsize=10_000)
+        # Event/session rows are mirrored into a SQLite database (batched
+        # executemany per flush) so recaps can run indexed queries; the
+        # connection lives on the writer thread
+        self._db_batches: dict[str, list[tuple]] = {'events': [], 'sessions': []}
+        self._database: RecapDatabase | None = None
+        # Append-mode file descriptors cached per log file in LRU order; only
+        # the writer thread touches them
+        self._file_descriptors: OrderedDict[str, int] = OrderedDict()
+        self._batches_since_sync: int = 0
+        self._last_sync: float = time.monotonic()
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+        atexit.register(self._shutdown)
+        self.warm_from_disk()
+
+    def warm_from_disk(self) -> None:
+        """
+        Marks guilds whose directory already exists as initialized, using one
+        scandir instead of a per-guild stat/open chain at startup
+        """
+        with os.scandir(self.DATA_PATH) as entries:
+            for entry in entries:
+                if not entry.is_dir() or not entry.name.isdigit():
+                    continue
+                guild_id = int(entry.name)
+                self._guild_paths[guild_id] = (os.path.join(entry.path, self.EVENT_LOG_FILENAME),
+                                               os.path.join(entry.path, self.SESSION_LOG_FILENAME),
+                                               os.path.join(entry.path, self.GUILD_EVENTS_FILENAME))
+                self.initialized_guilds_ids.add(guild_id)
+
+    def _buffer_line(self, path: str, line: bytes) -> None:
+        buffer = self._buffers.setdefault(path, [])
+        buffer.append(line)
+        if len(buffer) >= self.batch_size:
+            self._flush_path(path)
+
+    def _flush_path(self, path: str) -> None:
+        buffer = self._buffers.get(path)
+        if not buffer:
+            return
+        self._buffers[path] = []
+        try:
+            self._write_queue.put_nowait(('file', path, b''.join(buffer)))
+        except queue.Full:
+            logger.warning(f'Write queue is full, dropping {len(buffer)} buffered lines for {path}')
+
+    def _buffer_row(self, table: str, row: tuple) -> None:
+        batch = self._db_batches[table]
+        batch.append(row)
+        if len(batch) >= self.batch_size:
+            self._flush_table(table)
+
+    def _flush_table(self, table: str) -> None:
+        batch = self._db_batches[table]
+        if not batch:
+            return
+        self._db_batches[table] = []
+        try:
+            self._write_queue.put_nowait(('db', table, batch))
+        except queue.Full:
+            logger.warning(f'Write queue is full, dropping {len(batch)} rows for table {table}')
+
+    def flush_all(self) -> None:
+        for path in self._buffers:
+            self._flush_path(path)
+        for table in self._db_batches:
+            self._flush_table(table)
+
+    def _writer_loop(self) -> None:
+        while True:
+            batch: list[tuple] = [self._write_queue.get()]
+            while len(batch) < 256 and not self._write_queue.empty():
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            grouped_lines: dict[str, list[bytes]] = {}
+            grouped_rows: dict[str, list[tuple]] = {}
+            for kind, target, payload in batch:
+                if kind == 'file':
+                    grouped_lines.setdefault(target, []).append(payload)
+                else:
+                    grouped_rows.setdefault(target, []).extend(payload)
+            for path, payloads in grouped_lines.items():
+                try:
+                    os.write(self._get_fd(path), b''.join(payloads))
+                except OSError:
+                    logger.exception(f'Failed to write {len(payloads)} batches to {path}')
+            for table, rows in grouped_rows.items():
+                try:
+                    self._get_database().insert_rows(table, rows)
+                except Exception:
+                    logger.exception(f'Failed to insert {len(rows)} rows into table {table}')
+            if grouped_lines:
+                self._maybe_sync(len(grouped_lines))
+            for _ in batch:
+                self._write_queue.task_done()
+
+    def _maybe_sync(self, written_batches: int) -> None:
+        self._batches_since_sync += written_batches
+        if (self._batches_since_sync < self.durability_batch
+                and time.monotonic() - self._last_sync < self.durability_interval_s):
+            return
+        for fd in self._file_descriptors.values():
+            try:
+                os.fsync(fd)
+            except OSError:
+                logger.exception('Failed to fsync a log file descriptor')
+        self._batches_since_sync = 0
+        self._last_sync = time.monotonic()
+
+    def _get_database(self) -> RecapDatabase:
+        # Created lazily so the sqlite connection belongs to the writer thread
+        if self._database is None:
+            self._database = RecapDatabase(self.DATA_PATH)
+        return self._database
+
+    def _get_fd(self, path: str) -> int:
+        fd = self._file_descriptors.get(path)
+        if fd is None:
+            # Raw O_APPEND descriptor: batches are written with a single
+            # os.write, so there is nothing for a BufferedWriter to coalesce and
+            # its per-write lock and copy are skipped
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # Advise sequential access so the kernel prefetches sensibly
+                # when the recap side reads the log back; free to set on the
+                # append path, no-op on platforms without it
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except (AttributeError, OSError):
+                pass
+            self._file_descriptors[path] = fd
+            if len(self._file_descriptors) > self.MAX_OPEN_FILES:
+                evicted_path, evicted_fd = self._file_descriptors.popitem(last=False)
+                try:
+                    # fsync before closing: an evicted descriptor is invisible
+                    # to _maybe_sync, so without this its data could sit in the
+                    # page cache past the promised durability window
+                    os.fsync(evicted_fd)
+                    os.close(evicted_fd)
+                except OSError:
+                    logger.exception(f'Failed to close evicted log file {evicted_path}')
+        else:
+            self._file_descriptors.move_to_end(path)
+        return fd
+
+    def _close_all_handles(self) -> None:
+        for path, fd in self._file_descriptors.items():
+            try:
+                os.fsync(fd)
+                os.close(fd)
+            except OSError:
+                logger.exception(f'Failed to close log file {path}')
+        self._file_descriptors.clear()
+
+    def _shutdown(self) -> None:
+        self.flush_all()
+        self._write_queue.join()
+        self._close_all_handles()
+        if self._database is not None:
+            self._database.close()
 
     def ensure_guild_files_exist(self, guild_id: int) -> None:
         if guild_id in self.initialized_guilds_ids:
             return
         guild_dir = os.path.join(self.DATA_PATH, str(guild_id))
-        if not os.path.exists(guild_dir):
-            os.mkdir(guild_dir)
+        os.makedirs(guild_dir, exist_ok=True)
         event_log_file = os.path.join(guild_dir, self.EVENT_LOG_FILENAME)
         session_log_file = os.path.join(guild_dir, self.SESSION_LOG_FILENAME)
         metadata_event_file = os.path.join(guild_dir, self.GUILD_EVENTS_FILENAME)
-        metadata_snapshot_file = os.path.join(guild_dir, self.GUILD_METADATA_SNAPSHOT_FILENAME)
-        if not os.path.exists(event_log_file):
-            with open(event_log_file, 'w') as file:
-                file.write(self.EVENT_LOG_HEADER)
-        if not os.path.exists(session_log_file):
-            with open(session_log_file, 'w') as file:
-                file.write(self.SESSION_LOG_HEADER)
-        for filename in [metadata_event_file, metadata_snapshot_file]:
-            if not os.path.exists(filename):
-                with open(filename, 'w') as file:
-                    file.write('')
+        # Append-mode open instead of exists()+'w': creates the file if missing,
+        # never truncates, and no TOCTOU race when on_ready and on_guild_join
+        # fire close together. tell() == 0 also repairs an empty file left
+        # behind by a crash between create and header write
+        for log_file, header in [(event_log_file, self.EVENT_LOG_HEADER),
+                                 (session_log_file, self.SESSION_LOG_HEADER)]:
+            with open(log_file, 'ab') as file:
+                if file.tell() == 0:
+                    file.write(header.encode('utf-8'))
+        # The JSONL/snapshot files need no header and are created lazily by the
+        # append-mode open on first write
+        self._guild_paths[guild_id] = (event_log_file, session_log_file, metadata_event_file)
         self.initialized_guilds_ids.add(guild_id)
 
-    def log_event(self, member_id: int, member_name: str, timestamp: float, guild_id: int, guild_name: str,
+    def log_event(self, member_id: int, member_name: str, timestamp: int, guild_id: int, guild_name: str,
                   channel_id: int, channel_name: str, event_type: str) -> None:
-        self.ensure_guild_files_exist(guild_id)
-        event_csv_string: str = (f'{member_id},{member_name},{timestamp},{guild_id},{guild_name},'
-                                 f'{channel_id},{channel_name},{event_type}\n')
+        if guild_id not in self.initialized_guilds_ids:
+            self.ensure_guild_files_exist(guild_id)
+        event_csv_string: str = ','.join((str(member_id), _csv_field(member_name), str(timestamp),
+                                          str(guild_id), _csv_field(guild_name), str(channel_id),
+                                          _csv_field(channel_name), event_type)) + '\n'
+
+        self._buffer_line(self._guild_paths[guild_id][0], event_csv_string.encode('utf-8'))
+        self._buffer_row('events', (member_id, member_name, timestamp, guild_id, guild_name,
+                                    channel_id, channel_name, event_type))
 
-        event_log_path = os.path.join(self.DATA_PATH, str(guild_id), self.EVENT_LOG_FILENAME)
-        with open(event_log_path, 'a') as event_log:
-            event_log.write(event_csv_string)
+    def log_events(self, member_id: int, member_name: str, timestamp: int, guild_id: int, guild_name: str,
+                   channel_events: list[tuple[int, str, str]]) -> None:
+        """
+        Logs several events sharing one member/guild/timestamp (e.g. the leave+join
+        pair of a channel switch) as a single buffered append, stringifying the
+        shared fields only once
+        """
+        if guild_id not in self.initialized_guilds_ids:
+            self.ensure_guild_files_exist(guild_id)
+        member_id_str: str = str(member_id)
+        member_name_safe: str = _csv_field(member_name)
+        timestamp_str: str = str(timestamp)
+        guild_id_str: str = str(guild_id)
+        guild_name_safe: str = _csv_field(guild_name)
+        rows: str = ''.join(','.join((member_id_str, member_name_safe, timestamp_str, guild_id_str,
+                                      guild_name_safe, str(channel_id), _csv_field(channel_name),
+                                      event_type)) + '\n'
+                            for channel_id, channel_name, event_type in channel_events)
+        self._buffer_line(self._guild_paths[guild_id][0], rows.encode('utf-8'))
+        for channel_id, channel_name, event_type in channel_events:
+            self._buffer_row('events', (member_id, member_name, timestamp, guild_id, guild_name,
+                                        channel_id, channel_name, event_type))
 
-    def log_session(self, member_id: int, member_name: str, start_time: float, duration: float,
+    def log_session(self, member_id: int, member_name: str, start_time: int, duration: int,
                     guild_id: int, guild_name: str, channel_id: int, channel_name: str, session_type: str) -> None:
-        self.ensure_guild_files_exist(guild_id)
-        session_csv_string: str = (f'{member_id},{member_name},{start_time},{duration},{guild_id},{guild_name},'
-                                   f'{channel_id},{channel_name},{session_type}\n')
+        if guild_id not in self.initialized_guilds_ids:
+            self.ensure_guild_files_exist(guild_id)
+        session_csv_string: str = ','.join((str(member_id), _csv_field(member_name), str(start_time),
+                                            str(duration), str(guild_id), _csv_field(guild_name),
+                                            str(channel_id), _csv_field(channel_name), session_type)) + '\n'
 
-        session_log_path = os.path.join(self.DATA_PATH, str(guild_id), self.SESSION_LOG_FILENAME)
-        with open(session_log_path, 'a') as session_log:
-            session_log.write(session_csv_string)
+        self._buffer_line(self._guild_paths[guild_id][1], session_csv_string.encode('utf-8'))
+        self._buffer_row('sessions', (member_id, member_name, start_time, duration, guild_id, guild_name,
+                                      channel_id, channel_name, session_type))
 
-    def _append_guild_metadata(self, timestamp: float, guild_id: int, guild_event_type: str, payload: dict) -> None:
-        logger.debug(f'Guild {guild_id} event type {guild_event_type}')
-        self.ensure_guild_files_exist(guild_id)
+    def _append_guild_metadata(self, timestamp: int, guild_id: int, guild_event_type: str, payload: dict) -> None:
+        logger.debug('Guild %s event type %s', guild_id, guild_event_type)
+        if guild_id not in self.initialized_guilds_ids:
+            self.ensure_guild_files_exist(guild_id)
 
-        json_object = {'schema_version': self.json_schema_version, 'timestamp': timestamp,
+        json_object = {'schema_version': self.JSON_SCHEMA_VERSION, 'timestamp': timestamp,
                        'guild_event': guild_event_type, 'guild_id': guild_id, 'payload': payload}
-        filename: str = os.path.join(self.DATA_PATH, str(guild_id), self.GUILD_EVENTS_FILENAME)
-        with open(filename, 'a') as event_file:
-            json.dump(json_object, event_file)
-            event_file.write('\n')
+        self._buffer_line(self._guild_paths[guild_id][2], _json_line(json_object))
 
-    def log_guild_channel_add(self, timestamp: float, guild_id: int, channel_id: int,
+    def log_guild_channel_add(self, timestamp: int, guild_id: int, channel_id: int,
                               channel_name: str, channel_category_id: int | None, channel_type: str) -> None:
         payload = {
             'channel_id': channel_id,
@@ -96,7 +334,7 @@ class DataHandler:
         }
         self._append_guild_metadata(timestamp, guild_id, GuildEvent.CHANNEL_ADD.value, payload )
 
-    def log_guild_channel_remove(self, timestamp: float, guild_id: int, channel_id: int,
+    def log_guild_channel_remove(self, timestamp: int, guild_id: int, channel_id: int,
                                  channel_name: str, channel_category_id: int | None, channel_type: str) -> None:
         payload = {
             'channel_id': channel_id,
@@ -106,7 +344,7 @@ class DataHandler:
         }
         self._append_guild_metadata(timestamp, guild_id, GuildEvent.CHANNEL_REMOVE.value, payload)
 
-    def log_guild_channel_rename(self, timestamp: float, guild_id: int, channel_id: int,
+    def log_guild_channel_rename(self, timestamp: int, guild_id: int, channel_id: int,
                                  channel_name_old: str, channel_name_new: str, channel_category_id: int | None,
                                  channel_type: str) -> None:
         payload = {
@@ -118,7 +356,7 @@ class DataHandler:
         }
         self._append_guild_metadata(timestamp, guild_id, GuildEvent.CHANNEL_RENAME.value, payload)
 
-    def log_guild_channel_category_change(self, timestamp: float, guild_id: int, channel_id: int, channel_name: str,
+    def log_guild_channel_category_change(self, timestamp: int, guild_id: int, channel_id: int, channel_name: str,
                                           channel_category_old: int | None, channel_category_new: int | None,
                                           channel_type: str) -> None:
         payload = {
@@ -130,28 +368,28 @@ class DataHandler:
         }
         self._append_guild_metadata(timestamp, guild_id, GuildEvent.CHANNEL_CATEGORY_CHANGE.value, payload)
 
-    def log_guild_member_join(self, timestamp: float, guild_id: int, member_id: int, member_name: str) -> None:
+    def log_guild_member_join(self, timestamp: int, guild_id: int, member_id: int, member_name: str) -> None:
         payload = {
             'member_id': member_id,
             'member_name': member_name,
         }
         self._append_guild_metadata(timestamp, guild_id, GuildEvent.MEMBER_JOIN.value, payload)
 
-    def log_guild_member_remove(self, timestamp: float, guild_id: int, member_id: int, member_name: str) -> None:
+    def log_guild_member_remove(self, timestamp: int, guild_id: int, member_id: int, member_name: str) -> None:
         payload = {
             'member_id': member_id,
             'member_name': member_name,
         }
         self._append_guild_metadata(timestamp, guild_id, GuildEvent.MEMBER_REMOVE.value, payload)
 
-    def log_guild_rename(self, timestamp: float, guild_id: int, guild_name_old: str, guild_name_new: str) -> None:
+    def log_guild_rename(self, timestamp: int, guild_id: int, guild_name_old: str, guild_name_new: str) -> None:
         payload = {
             'guild_name_old': guild_name_old,
             'guild_name_new': guild_name_new,
         }
         self._append_guild_metadata(timestamp, guild_id, GuildEvent.GUILD_RENAME.value, payload)
 
-    def log_guild_bot_join(self, timestamp: float, guild_id: int, guild_name: str) -> None:
+    def log_guild_bot_join(self, timestamp: int, guild_id: int, guild_name: str) -> None:
         payload = {
             'guild_name': guild_name,
         }
@@ -0,0 +1,67 @@
+import os
+import sqlite3
+import logging
+
+
+logger = logging.getLogger('ServerRecapBot.database')
+
+class RecapDatabase:
+    """SQLite mirror of the CSV logs so recap queries are indexed lookups instead of file scans.
+
+    Inserts arrive in batches from the DataHandler writer thread and are committed
+    as a single transaction, so there is one fsync per flush interval instead of
+    one per event. The connection must only be used from the thread that created it.
+    """
+
+    def __init__(self, data_path: str):
+        self.DB_FILENAME: str = 'recap.db'
+        # check_same_thread=False only so shutdown can close the connection from
+        # the main thread after the write queue has drained; all inserts stay on
+        # the writer thread
+        self.connection = sqlite3.connect(os.path.join(data_path, self.DB_FILENAME),
+                                          isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # Checkpoint the WAL every ~1000 pages so it cannot grow unbounded
+        # between restarts; recap reads still never block the writer
+        self.connection.execute('PRAGMA wal_autocheckpoint=1000')
+        self._create_tables()
+
+    def _create_tables(self) -> None:
+        self.connection.execute('CREATE TABLE IF NOT EXISTS events('
+                                'member_id INTEGER, member_name TEXT, timestamp INTEGER, '
+                                'guild_id INTEGER, guild_name TEXT, '
+                                'channel_id INTEGER, channel_name TEXT, event_type TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS sessions('
+                                'member_id INTEGER, member_name TEXT, start_time INTEGER, duration INTEGER, '
+                                'guild_id INTEGER, guild_name TEXT, '
+                                'channel_id INTEGER, channel_name TEXT, session_type TEXT)')
+        # Superseded by the (guild, member, time) indexes below
+        self.connection.execute('DROP INDEX IF EXISTS idx_events_guild_time')
+        self.connection.execute('DROP INDEX IF EXISTS idx_sessions_guild_time')
+        # (guild, member, time) covers both the per-guild recap scan and the
+        # per-member drill-down without a second lookup
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_events_guild_member_time '
+                                'ON events(guild_id, member_id, timestamp)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_sessions_guild_member_time '
+                                'ON sessions(guild_id, member_id, start_time)')
+
+    INSERT_STATEMENTS: dict[str, str] = {
+        'events': 'INSERT INTO events VALUES (?,?,?,?,?,?,?,?)',
+        'sessions': 'INSERT INTO sessions VALUES (?,?,?,?,?,?,?,?,?)',
+    }
+
+    def insert_rows(self, table: str, rows: list[tuple]) -> None:
+        self.connection.execute('BEGIN')
+        try:
+            self.connection.executemany(self.INSERT_STATEMENTS[table], rows)
+            self.connection.execute('COMMIT')
+        except Exception:
+            # Roll back so a transient failure (disk full, SQLITE_BUSY) costs
+            # this batch only; leaving the transaction open would wedge every
+            # later batch with "cannot start a transaction within a transaction"
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def close(self) -> None:
+        self.connection.close()